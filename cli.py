@@ -12,14 +12,19 @@ async def stream_tokens(uri, prompt):
 
         # Keep receiving tokens until the connection is closed by the server
         t0 = time.time()
-        num_token = 0
+        # Frames carry several coalesced tokens, so count characters for throughput
+        num_frames = 0
+        num_chars = 0
         try:
             while True:
                 token = await websocket.recv()
+                if isinstance(token, bytes):
+                    token = token.decode()
                 if token == None:
                     break
                 print(colored(token, "green"), end='', flush=True)
-                num_token += 1
+                num_frames += 1
+                num_chars += len(token)
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
@@ -27,8 +32,9 @@ async def stream_tokens(uri, prompt):
             print("\n")
             print(colored(
                 "Time elapsed: {:.2f} seconds".format(dt) + 
-                " Number of tokens/sec: {:.2f}".format(num_token/dt) + 
-                " Number of tokens: {}".format(num_token), "blue"))
+                " Characters/sec: {:.2f}".format(num_chars/dt) + 
+                " Number of characters: {}".format(num_chars) + 
+                " Number of frames: {}".format(num_frames), "blue"))
             print()
 
 async def interactive_client(args):
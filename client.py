@@ -14,40 +14,85 @@ class ChatApp:
         self.port = port
         self.session_id = None
         self.session_titles = {}
+        self.base = f"http://{host}:{port}"
+        self._http = requests.Session()
+        self._http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_timer = None
 
     async def stream_tokens(self, uri, prompt):
         try:
             async with websockets.connect(uri) as websocket:
                 await websocket.send(prompt)
                 t0 = time.time()
-                num_token = 0
+                # Frames carry several coalesced tokens, so count characters for throughput
+                num_frames = 0
+                num_chars = 0
                 try:
                     while True:
                         token = await websocket.recv()
+                        if isinstance(token, bytes):
+                            token = token.decode()
                         img_tag_pattern = r'<img\b[^>]*>'
                         if re.search(img_tag_pattern, token):
                             token = token.replace("<host>", self.host).replace("<port>", str(self.port))
                         self.send_to_webview("assistant", token)
-                        num_token += 1
+                        num_frames += 1
+                        num_chars += len(token)
                 except websockets.exceptions.ConnectionClosed:
                     print("Connection closed")
                 finally:
                     dt = time.time() - t0
-                    print(f"Time elapsed: {dt:.2f} seconds, Number of tokens/sec: {num_token/dt:.2f}, Number of tokens: {num_token}")
+                    print(f"Time elapsed: {dt:.2f} seconds, Characters/sec: {num_chars/dt:.2f}, Number of characters: {num_chars}, Number of frames: {num_frames}")
                     if self.session_titles[self.session_id] == "New session":
-                        self.generate_title(self.session_id)
+                        # Summarization can take seconds; don't stall the event loop waiting on it
+                        asyncio.get_running_loop().run_in_executor(None, self.generate_title, self.session_id)
         except Exception as e:
             traceback.print_exc()
             self.send_to_webview("system", f"WebSocket connection failed: {e}")
 
     def send_to_webview(self, role, message):
-        sanitized_message = json.dumps(message)
-        window.evaluate_js(f'addMessage("{role}", {sanitized_message})')
+        # Queue the message and flush at most once per frame (~60 Hz)
+        with self._pending_lock:
+            self._pending.append((role, message))
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(0.016, self._flush)
+                self._flush_timer.start()
+
+    def _flush(self):
+        # Serialize flushes so a slow re-render can't let the next batch overtake this one
+        with self._flush_lock:
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = []
+                self._flush_timer = None
+
+            # Group consecutive messages of the same role into one bridge call
+            batches = []
+            for role, message in pending:
+                if batches and batches[-1][0] == role:
+                    batches[-1][1].append(message)
+                else:
+                    batches.append((role, [message]))
+            for role, messages in batches:
+                if role == "assistant":
+                    # Streamed tokens are concatenated by the page anyway; serialize one string, not a list
+                    messages = ["".join(messages)]
+                window.evaluate_js(f'appendMessageBatch("{role}", {json.dumps(messages)})')
+
+    def _clear_chat(self):
+        # Drop queued messages so nothing from the previous session lands after the clear
+        with self._flush_lock:
+            with self._pending_lock:
+                self._pending = []
+            window.evaluate_js('clearChat()')
 
     def send_message(self, message):
         if self.session_id is None:
             try:
-                response = requests.get(f"http://{self.host}:{self.port}/session")
+                response = self._http.get(f"{self.base}/session")
                 self.session_id = str(response.json())
                 window.evaluate_js(f'addSession("{self.session_id}", "New session")')
                 self.session_titles[self.session_id] = "New session"
@@ -66,12 +111,11 @@ class ChatApp:
 
     def initialize(self):
         try:
-            response = requests.get(f"http://{self.host}:{self.port}/session-list")
+            response = self._http.get(f"{self.base}/session-list")
             sessions = response.json()
             for session in sessions:
-                escaped_title = json.dumps(session["title"])
-                self.session_titles[str(session["id"])] = escaped_title
-                window.evaluate_js(f'addSession("{session["id"]}", {escaped_title})')
+                self.session_titles[str(session["id"])] = json.dumps(session["title"])
+            window.evaluate_js(f'addSessions({json.dumps(sessions)})')
         except Exception as e:
             traceback.print_exc()
             self.send_to_webview("system", f"Failed to initialize sessions: {e}")
@@ -79,7 +123,8 @@ class ChatApp:
     def load_session(self, session_id):
         if session_id != self.session_id:
             try:
-                response = requests.get(f"http://{self.host}:{self.port}/session/{session_id}")
+                self._clear_chat()
+                response = self._http.get(f"{self.base}/session/{session_id}")
                 chat_data = response.json()
                 for message in chat_data["messages"]:
                     if message["role"] == "user" or message["role"] == "assistant":
@@ -97,17 +142,17 @@ class ChatApp:
 
     def delete_session(self, session_id):
         try:
-            requests.delete(f"http://{self.host}:{self.port}/session/{session_id}")
+            self._http.delete(f"{self.base}/session/{session_id}")
             if session_id == self.session_id:
                 self.reset_session()
-            window.evaluate_js(f'clearChat()')
+            self._clear_chat()
         except Exception as e:
             traceback.print_exc()
             self.send_to_webview("system", f"Failed to delete session: {e}")
 
-    def generate_title(self, session_id):
+    def generate_title(self, session_id, regenerate=False):
         try:
-            response = requests.get(f"http://{self.host}:{self.port}/session/{session_id}/title")
+            response = self._http.get(f"{self.base}/session/{session_id}/title", params={"regenerate": "true"} if regenerate else None)
             title = response.json()
             escaped_title = json.dumps(title)
             self.session_titles[session_id] = escaped_title
@@ -118,7 +163,11 @@ class ChatApp:
 
 def start_asyncio_loop():
     global event_loop
-    event_loop = asyncio.new_event_loop()
+    try:
+        import uvloop
+        event_loop = uvloop.new_event_loop()
+    except ImportError:
+        event_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(event_loop)
     event_loop.run_forever()
 
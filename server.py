@@ -1,3 +1,8 @@
+import os
+# Must be set before torch initializes CUDA; grow segments in place instead of fragmenting on long sessions
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512,garbage_collection_threshold:0.8")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
 import torch
 import flash_attn
 import uvicorn
@@ -5,21 +10,27 @@ import gc
 import asyncio
 import argparse
 import io
+import threading
 from fastapi import FastAPI, WebSocket, Depends
 from fastapi.responses import Response
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm import Session as DBSession
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, AutoConfig, TextIteratorStreamer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, AutoConfig, AsyncTextIteratorStreamer, StaticCache, StoppingCriteria, StoppingCriteriaList, pipeline
 from diffusers import StableDiffusionXLPipeline, DPMSolverSinglestepScheduler, AutoencoderTiny
 
 from session import Session, SessionManager, SessionDB, SessionImageDB, get_db
 
+STREAM_FLUSH_TOKENS = 8
+STREAM_FLUSH_INTERVAL = 0.02  # seconds
+
 app = FastAPI()
 session_manager = SessionManager()
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--model', action='store', default="meta-llama/Meta-Llama-3-8B-Instruct")
-parser.add_argument('--port', action='store', default=8000)
+parser.add_argument('--port', action='store', type=int, default=8000)
+parser.add_argument('--max_new_tokens', action='store', type=int, default=1024)
+parser.add_argument('--compile', action='store_true', default=False)
 parser.add_argument('--image_generation', action='store_true', default=False)
 parser.add_argument('--image_model', action='store', default="sd-community/sdxl-flash")
 parser.add_argument('--image_cpu_offload', action='store_true', default=False)
@@ -37,9 +48,25 @@ model = AutoModelForCausalLM.from_pretrained(
     device_map='auto',
     config=config,
     quantization_config=bnb_config,
-    attn_implementation="flash_attention_2"
+    # Several transformers releases reject a StaticCache with flash-attention-2
+    attn_implementation="sdpa" if args.compile else "flash_attention_2"
 )
-tokenizer = AutoTokenizer.from_pretrained(args.model)
+static_cache = None
+if args.compile:
+    # The static cache lives on one device; layers placed on other GPUs would write into the wrong one
+    if len(set(model.hf_device_map.values())) > 1:
+        parser.error("--compile requires the model to fit on a single device")
+    # One KV cache sized to the full context, reset per request, keeps the decode step's
+    # shapes and addresses fixed so the compiled forward can replay its CUDA graphs
+    static_cache = StaticCache(
+        config=config,
+        max_batch_size=1,
+        max_cache_len=config.max_position_embeddings,
+        device=model.device,
+        dtype=torch.bfloat16
+    )
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
 terminators = [
     tokenizer.eos_token_id,
     tokenizer.convert_tokens_to_ids(""),
@@ -48,6 +75,8 @@ terminators = [
 summarizer = pipeline(
     task="summarization", 
     model="facebook/bart-large-cnn", 
+    device=0,
+    torch_dtype=torch.bfloat16,
     min_length=2, 
     max_length=10,
     do_sample=True,
@@ -64,58 +93,117 @@ if args.image_generation:
     if args.image_cpu_offload:
         sdxl_pipe.enable_sequential_cpu_offload()
 
-async def stream_tokens(streamer: TextIteratorStreamer):
-    for token in streamer:
-        yield token
-    yield None
+# A single long-lived thread runs every generate() call
+gen_executor = ThreadPoolExecutor(max_workers=1)
 
-async def generate_response(prompt: str):
-    torch.cuda.empty_cache()
-    gc.collect()
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda")
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True) 
+# Stops generation once the request that started it has gone away
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+# Prompt staging buffers, allocated once so prompt ingest doesn't hit cudaMalloc
+pinned_input_ids = torch.empty(config.max_position_embeddings, dtype=torch.long, pin_memory=True)
+device_input_ids = torch.empty(config.max_position_embeddings, dtype=torch.long, device="cuda")
+device_attention_mask = torch.ones(config.max_position_embeddings, dtype=torch.long, device="cuda")
+
+# Release load-time scratch memory once; the caching allocator reuses blocks after this
+torch.cuda.empty_cache()
+
+async def generate_response(input_ids: torch.Tensor, stop_event: threading.Event):
+    num_tokens = input_ids.shape[-1]
+    # Tokens are handed to the event loop through an asyncio.Queue, so waiting on them doesn't block it
+    streamer = AsyncTextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
     generation_kwargs = {
-        "input_ids": inputs["input_ids"],
-        "attention_mask": inputs["attention_mask"],
         "streamer": streamer,
+        "stopping_criteria": StoppingCriteriaList([StopOnEvent(stop_event)]),
         "do_sample": True,
         "temperature": 0.6,
         "top_p": 0.9,
-        "max_length": config.max_position_embeddings,
+        "max_new_tokens": args.max_new_tokens,
     }
 
-    # Run the generation in a separate thread
-    thread = Thread(target=model.generate, kwargs=generation_kwargs)
-    thread.start()
+    # Run the generation on the dedicated generation thread, without autograd bookkeeping
+    def generate():
+        # Stage the prompt through the preallocated buffers. This runs on the
+        # generation thread, so requests can't overwrite each other's prompt.
+        try:
+            # The client disconnected while this request was queued behind another generation
+            if stop_event.is_set():
+                streamer.end()
+                return
+            pinned_input_ids[:num_tokens].copy_(input_ids[0])
+            device_input_ids[:num_tokens].copy_(pinned_input_ids[:num_tokens], non_blocking=True)
+            if static_cache is not None:
+                static_cache.reset()
+            with torch.inference_mode():
+                model.generate(
+                    input_ids=device_input_ids[:num_tokens].unsqueeze(0),
+                    attention_mask=device_attention_mask[:num_tokens].unsqueeze(0),
+                    past_key_values=static_cache,
+                    **generation_kwargs
+                )
+        except Exception:
+            # End the stream so the loop below finishes; awaiting the future then re-raises the error
+            streamer.end()
+            raise
+
+    future = gen_executor.submit(generate)
 
     # Start streaming tokens
-    async for token in stream_tokens(streamer):
+    async for token in streamer:
         yield token
 
-    thread.join()
+    await asyncio.wrap_future(future)
 
-def make_title(session: Session):
+# Last title per session with a hash of the text it was summarized from, so repeated fetches skip the summarizer
+title_cache = {}
+
+def make_title(session: Session, regenerate: bool = False):
     messages = session.get_messages()[-2:]
     prompt = "\n".join([message["content"] for message in messages])
-    return summarizer(prompt)
+    prompt_hash = hash(prompt)
+    cached = title_cache.get(session.id)
+    if regenerate or cached is None or cached[0] != prompt_hash:
+        with torch.inference_mode():
+            title = summarizer(prompt)[0]["summary_text"]
+        title_cache[session.id] = (prompt_hash, title)
+    return title_cache[session.id][1]
+
+def measure_message_overhead():
+    # Template tokens (role markers, separators) one message adds on top of its content.
+    # Measured as the difference between a one- and two-turn chat, so any constant
+    # preamble cancels out, and rounded up so truncation estimates err toward keeping turns.
+    turn = [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hello"}]
+    one_turn = len(tokenizer.apply_chat_template(turn, tokenize=True))
+    two_turns = len(tokenizer.apply_chat_template(turn + turn, tokenize=True))
+    body = len(tokenizer("hello", add_special_tokens=False)["input_ids"])
+    return -(-(two_turns - one_turn - 2 * body) // 2)
+
+message_overhead = measure_message_overhead()
 
 def make_prompt(session: Session):
-    inputs = tokenizer.apply_chat_template(
-        session.get_messages(),
-        add_generation_prompt=True,
-        return_tensors="pt",
-        tokenize=True
-    )
-    num_tokens = inputs.shape[-1]
-    if num_tokens > int(config.max_position_embeddings * 0.9):
-        session.truncate_messages()
-        return make_prompt(session)
-    else:
-        return tokenizer.apply_chat_template(
+    # Leave room in the context window for the tokens we are about to generate
+    budget = config.max_position_embeddings - args.max_new_tokens
+    while True:
+        inputs = tokenizer.apply_chat_template(
             session.get_messages(),
             add_generation_prompt=True,
-            tokenize=False
+            return_tensors="pt",
+            tokenize=True
         )
+        num_tokens = inputs.shape[-1]
+        # Never truncate away the current user message
+        if num_tokens <= budget or len(session.messages) <= 2:
+            return inputs
+        # Drop old turns, estimating the savings from the dropped messages' content plus
+        # template overhead rather than re-tokenizing the whole history after every truncation.
+        # The estimate errs high, so the full re-tokenization above re-checks the budget.
+        while num_tokens > budget and len(session.messages) > 2:
+            for message in session.truncate_messages():
+                num_tokens -= len(tokenizer(message["content"], add_special_tokens=False)["input_ids"]) + message_overhead
 
 def generate_image(session_id: int, prompt: str, db: DBSession):
     torch.cuda.empty_cache()
@@ -135,6 +223,18 @@ def generate_image(session_id: int, prompt: str, db: DBSession):
     image_url = f'<img class="scaled" src="http://<host>:<port>/image/{image_db.id}" alt="{prompt}" />'    
     return image_url
 
+async def watch_disconnect(websocket: WebSocket, stop_event: threading.Event):
+    # Clients send nothing after the prompt, so the next message is the disconnect
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    except Exception:
+        # The socket is no longer usable either way
+        pass
+    stop_event.set()
+
 @app.websocket("/stream/{session_id}")
 async def stream(websocket: WebSocket, session_id: int, db: DBSession = Depends(get_db)):
     await websocket.accept()
@@ -152,21 +252,44 @@ async def stream(websocket: WebSocket, session_id: int, db: DBSession = Depends(
     else:
         session.add_user_message(message)
         session_manager.save_session(session, db)            
-        prompt = make_prompt(session)
-        completion = ""
+        # Tokenizing a long history takes tens of ms; keep it off the event loop
+        input_ids = await asyncio.to_thread(make_prompt, session)
+        completion_parts = []
+        # Coalesce tokens so each websocket frame carries several of them
+        buffer = []
+        loop = asyncio.get_running_loop()
+        last_flush = loop.time()
+        # Set when the client disconnects or the handler exits, so an abandoned
+        # generation (running or still queued) frees the generation thread
+        stop_event = threading.Event()
+        watcher = asyncio.create_task(watch_disconnect(websocket, stop_event))
         try:
-            async for token in generate_response(prompt):
-                if token is None:
-                    break
-                completion += token
-                await websocket.send_text(token)
-                await asyncio.sleep(0.01)
+            async for token in generate_response(input_ids, stop_event):
+                # The streamer emits empty strings while it waits for a word to complete
+                if not token:
+                    continue
+                completion_parts.append(token)
+                buffer.append(token)
+                now = loop.time()
+                if len(buffer) >= STREAM_FLUSH_TOKENS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                    await websocket.send_bytes("".join(buffer).encode())
+                    buffer.clear()
+                    last_flush = now
+                await asyncio.sleep(0)
+            if buffer:
+                await websocket.send_bytes("".join(buffer).encode())
         except Exception as e:
             print(f"Error: {e}")
         finally:
-            session.add_assistant_message(completion)
+            stop_event.set()
+            watcher.cancel()
+            session.add_assistant_message("".join(completion_parts))
             session_manager.save_session(session, db)            
-            await websocket.close()
+            try:
+                await websocket.close()
+            except Exception:
+                # The client already disconnected
+                pass
 
 
 @app.get("/session")
@@ -188,13 +311,14 @@ async def get_session_list(db: DBSession = Depends(get_db)):
 async def delete_session(session_id: int, db: DBSession = Depends(get_db)):
     session_manager.remove_session(session_id, db)
     db.commit()
+    # SQLite can hand this id to the next new session
+    title_cache.pop(session_id, None)
     return
 
 @app.get("/session/{session_id}/title")
-async def get_session_title(session_id: int, db: DBSession = Depends(get_db)):
+async def get_session_title(session_id: int, regenerate: bool = False, db: DBSession = Depends(get_db)):
     session = session_manager.get_session(session_id, db)
-    summary_response = make_title(session)
-    session.title = summary_response[0]["summary_text"]
+    session.title = await asyncio.to_thread(make_title, session, regenerate)
     db_session = db.query(SessionDB).filter(SessionDB.id == session.id).first()
     db_session.title = session.title
     db.add(db_session)
@@ -208,4 +332,4 @@ async def get_image(image_id: int, db: DBSession = Depends(get_db)):
     return Response(img_byte_arr.getvalue(), media_type="image/png")
 
 if __name__ == "__main__":        
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
+    uvicorn.run(app, host="0.0.0.0", port=args.port, loop="uvloop", http="httptools", ws="websockets")
@@ -43,11 +43,17 @@ class Session:
     def add_assistant_message(self, message):
         self.messages.append({"role": "assistant", "content": message})
 
+    @staticmethod
+    def _chat_messages(messages):
+        return [{"role": message["role"], "content": message["content"]} for message in messages if message["role"] != "image"]
+
     def get_messages(self):
-        return [{"role": message["role"], "content": message["content"]} for message in self.messages if message["role"] != "image"]
+        return self._chat_messages(self.messages)
     
     def truncate_messages(self):
+        dropped = self.messages[:2]
         self.messages = self.messages[2:]
+        return self._chat_messages(dropped)
 
 class SessionManager:
     def __init__(self):